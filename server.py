@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
 import websockets
 import json
@@ -7,22 +8,206 @@ import socket
 import logging
 import base64
 import sqlite3
-import datetime
+import struct
 import math  # Добавлен импорт math
+import time
+import zlib
+import itertools
+import multiprocessing
+import os
 from typing import Dict, Set, List, Optional
-from datetime import datetime
+from websockets.frames import Frame, Opcode
+from websockets.protocol import State
+
+try:
+    import orjson  # Быстрая сериализация JSON, если установлена
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # Более быстрый цикл событий, если установлен
+except ImportError:
+    uvloop = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('PacmanServer')
 
+# Расширения протокола, которые клиент может включить сообщением 'hello':
+# zlib - крупные сообщения приходят бинарным кадром b'Z' + raw deflate
+# binary_voice - голос приходит бинарным кадром b'V' + VOICE_HEADER + аудио
+# delta - после полного game_state приходят только изменения (сообщения 'delta')
+# static_map - стены и оформление карты приходят отдельным сообщением 'map' перед
+#              полным состоянием (после 'hello', потери сообщений и смены карты)
+#              и не повторяются в каждом game_state
+PROTOCOL_FEATURES = frozenset({'zlib', 'binary_voice', 'delta', 'static_map'})
+
+# Заголовок голосового кадра после байта b'V': id отправителя и номер пакета.
+# Клиент отправляет кадр того же формата, id отправителя сервер подставляет сам
+VOICE_HEADER = struct.Struct('<IH')
+
+# Заготовка компрессора: копия дешевле создания нового compressobj
+DEFLATE_TEMPLATE = zlib.compressobj(1, zlib.DEFLATED, -15)
+
+
+# json.dumps с нестандартными параметрами создает новый кодировщик на каждый вызов
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+def json_dumps(obj) -> str:
+    """Сериализация в JSON через orjson, если он доступен"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return JSON_ENCODER.encode(obj)
+
+
+def json_dumps_bytes(obj) -> bytes:
+    """Сериализация в JSON сразу в UTF-8: orjson возвращает bytes без перекодирования"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return JSON_ENCODER.encode(obj).encode()
+
+
+def json_loads(data):
+    """Разбор JSON через orjson, если он доступен (ошибки - json.JSONDecodeError)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def compress_payload(payload) -> bytes:
+    """Сжатие сообщения (str или UTF-8 bytes) в бинарный кадр b'Z' + raw deflate"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    compressor = DEFLATE_TEMPLATE.copy()
+    return b'Z' + compressor.compress(payload) + compressor.flush()
+
+
+def encode_frame(message, text: bool = False) -> bytes:
+    """Готовый к записи в сокет кадр WebSocket: str или bytes с text=True - текстовый"""
+    # Кадры сервера не маскируются; кадр без расширений (RSV1 не выставлен) -
+    # пишется только в соединения, где расширения не согласованы
+    if isinstance(message, str):
+        return Frame(Opcode.TEXT, message.encode()).serialize(mask=False)
+    return Frame(Opcode.TEXT if text else Opcode.BINARY, message).serialize(mask=False)
+
+
+def aabb_hit_any(left, right, top, bottom, rects) -> bool:
+    """Пересекает ли прямоугольник хотя бы один из rects (left, right, top, bottom)"""
+    # Скалярный цикл с выходом на первом пересечении: при десятках стен
+    # он быстрее любой векторизации
+    for rect_left, rect_right, rect_top, rect_bottom in rects:
+        if right > rect_left and left < rect_right and bottom > rect_top and top < rect_bottom:
+            return True
+    return False
+
+
+def build_grid(rects, cell: int) -> Dict[tuple, list]:
+    """Равномерная сетка: клетка (cx, cy) -> прямоугольники, которые ее задевают"""
+    grid = {}
+    for rect in rects:
+        left, right, top, bottom = rect
+        for cx in range(int(left // cell), int(right // cell) + 1):
+            for cy in range(int(top // cell), int(bottom // cell) + 1):
+                grid.setdefault((cx, cy), []).append(rect)
+    return grid
+
+
+def aabb_first_hit(left, right, top, bottom, rects, start: int = 0) -> int:
+    """Индекс первого из rects[start:], пересекающего прямоугольник; -1, если таких нет"""
+    # Только четыре сравнения с заранее посчитанными границами - без обращений к dict
+    for i in range(start, len(rects)):
+        rect_left, rect_right, rect_top, rect_bottom = rects[i]
+        if left < rect_right and right > rect_left and top < rect_bottom and bottom > rect_top:
+            return i
+    return -1
+
+
+def build_point_grid(items, cell: int, half_size: Optional[int] = None) -> Dict[tuple, tuple]:
+    """Равномерная сетка: клетка (cx, cy) -> (границы, индексы) объектов с центром в ней
+
+    Границы (left, right, top, bottom) считаются по полуразмеру half_size,
+    а если он не задан - по полю 'size' объекта
+    """
+    grid = {}
+    for index, item in enumerate(items):
+        key = (int(item['x'] // cell), int(item['y'] // cell))
+        size = item['size'] if half_size is None else half_size
+        bucket = grid.get(key)
+        if bucket is None:
+            bucket = grid[key] = ([], [])
+        bucket[0].append((item['x'] - size, item['x'] + size, item['y'] - size, item['y'] + size))
+        bucket[1].append(index)
+    return grid
+
 
 class DatabaseManager:
     """Менеджер базы данных для рейтингов и статистики"""
 
-    def __init__(self):
-        self.conn = sqlite3.connect('pacman_ratings.db', check_same_thread=False)
+    # INSERT ... RETURNING поддерживается начиная с SQLite 3.35
+    HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    # Время жизни кэша таблицы лидеров (секунды)
+    LEADERBOARD_CACHE_TTL = 300
+
+    # Тексты частых запросов. sqlite3 кэширует скомпилированные запросы по тексту,
+    # поэтому у каждого запроса один вариант строки и он не разбирается повторно
+    SQL_PLAYER_RATING = '''
+        SELECT r.score, r.games_played, r.wins, r.best_score
+        FROM ratings r
+        JOIN players p ON r.player_id = p.id
+        WHERE p.username = ?
+    '''
+    SQL_INSERT_PLAYER_RETURNING = 'INSERT INTO players (username) VALUES (?) ON CONFLICT DO NOTHING RETURNING id'
+    SQL_INSERT_PLAYER = 'INSERT OR IGNORE INTO players (username) VALUES (?)'
+    SQL_PLAYER_ID = 'SELECT id FROM players WHERE username = ?'
+    SQL_UPSERT_RATING = '''
+        INSERT INTO ratings (player_id, score, games_played, wins, best_score)
+        VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT (player_id) DO UPDATE SET
+            score = score + excluded.score,
+            games_played = games_played + 1,
+            wins = wins + excluded.wins,
+            best_score = MAX(best_score, excluded.best_score),
+            last_played = CURRENT_TIMESTAMP
+    '''
+    SQL_LEADERBOARD = '''
+        SELECT p.username, r.score, r.games_played, r.wins, r.best_score
+        FROM ratings r
+        JOIN players p ON r.player_id = p.id
+        ORDER BY r.score DESC
+        LIMIT ?
+    '''
+    SQL_INSERT_ACHIEVEMENT = 'INSERT INTO achievements (player_id, achievement_name) VALUES (?, ?)'
+
+    def __init__(self, db_path: str = 'pacman_ratings.db'):
+        self.db_path = db_path
+        # Чтения идут из потока цикла событий через conn, рейтинги пишутся из фонового
+        # потока через write_conn: чтение не видит незакоммиченную транзакцию записи
+        # и не ждет мьютекс ее соединения. У базы в памяти второго соединения быть не может
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        if db_path == ':memory:':
+            self.write_conn = self.conn
+        else:
+            self.write_conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        # Кэш сериализованной таблицы лидеров: limit -> (время, data_version, JSON)
+        self.leaderboard_cache: Dict[int, tuple] = {}
+        self.configure_connection(self.conn)
         self.create_tables()
+        if self.write_conn is not self.conn:
+            self.configure_connection(self.write_conn)
+
+    def configure_connection(self, conn: sqlite3.Connection):
+        """Настройка соединения SQLite (журнал WAL, кэш, таймаут блокировок)"""
+        # WAL не блокирует читателей во время записи и реже вызывает fsync,
+        # для базы в памяти журнал и mmap не имеют смысла
+        if self.db_path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        conn.execute('PRAGMA busy_timeout=5000')
 
     def create_tables(self):
         """Создание таблиц в базе данных"""
@@ -62,19 +247,14 @@ class DatabaseManager:
             )
         ''')
 
+        # Один рейтинг на игрока - нужен для UPSERT по player_id
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_player_id ON ratings (player_id)')
+
         self.conn.commit()
 
     def get_player_rating(self, username: str) -> Dict:
         """Получить рейтинг игрока"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT r.score, r.games_played, r.wins, r.best_score 
-            FROM ratings r 
-            JOIN players p ON r.player_id = p.id 
-            WHERE p.username = ?
-        ''', (username,))
-
-        result = cursor.fetchone()
+        result = self.conn.execute(self.SQL_PLAYER_RATING, (username,)).fetchone()
         if result:
             return {
                 'score': result[0],
@@ -85,89 +265,182 @@ class DatabaseManager:
         return {'score': 0, 'games_played': 0, 'wins': 0, 'best_score': 0}
 
     def update_player_rating(self, username: str, score: int, is_win: bool):
-        """Обновить рейтинг игрока"""
-        cursor = self.conn.cursor()
+        """Обновить рейтинг игрока (вызывается из потока записи db_worker)"""
+        conn = self.write_conn
+        # Все запросы выполняются в одной транзакции с одним коммитом
+        with conn:
+            # Создаем игрока если не существует, id возвращается сразу
+            rows = []
+            if self.HAS_RETURNING:
+                rows = conn.execute(self.SQL_INSERT_PLAYER_RETURNING, (username,)).fetchall()
+            else:
+                conn.execute(self.SQL_INSERT_PLAYER, (username,))
 
-        # Создаем игрока если не существует
-        cursor.execute('INSERT OR IGNORE INTO players (username) VALUES (?)', (username,))
-
-        # Получаем ID игрока
-        cursor.execute('SELECT id FROM players WHERE username = ?', (username,))
-        player_id = cursor.fetchone()[0]
-
-        # Получаем текущий рейтинг
-        cursor.execute('SELECT * FROM ratings WHERE player_id = ?', (player_id,))
-        current_rating = cursor.fetchone()
-
-        if current_rating:
-            # Обновляем существующий рейтинг
-            new_score = current_rating[2] + score
-            new_games = current_rating[3] + 1
-            new_wins = current_rating[4] + (1 if is_win else 0)
-            new_best_score = max(current_rating[5], score)
-
-            cursor.execute('''
-                UPDATE ratings 
-                SET score = ?, games_played = ?, wins = ?, best_score = ?, last_played = CURRENT_TIMESTAMP
-                WHERE player_id = ?
-            ''', (new_score, new_games, new_wins, new_best_score, player_id))
-        else:
-            # Создаем новый рейтинг
-            cursor.execute('''
-                INSERT INTO ratings (player_id, score, games_played, wins, best_score)
-                VALUES (?, ?, 1, ?, ?)
-            ''', (player_id, score, 1 if is_win else 0, score))
+            # Игрок уже существовал - получаем ID отдельным запросом
+            if not rows:
+                rows = conn.execute(self.SQL_PLAYER_ID, (username,)).fetchall()
+            player_id = rows[0][0]
 
-        self.conn.commit()
+            # Создаем или обновляем рейтинг одним запросом
+            conn.execute(self.SQL_UPSERT_RATING, (player_id, score, 1 if is_win else 0, score))
+
+    def invalidate_leaderboard(self):
+        """Сброс кэша таблицы лидеров после изменения рейтингов"""
+        # Вызывается из потока цикла событий, который и заполняет кэш: иначе
+        # устаревшая таблица, прочитанная до коммита, могла бы попасть в кэш после сброса
+        self.leaderboard_cache.clear()
 
     def get_leaderboard(self, limit: int = 10) -> List[Dict]:
         """Получить таблицу лидеров"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT p.username, r.score, r.games_played, r.wins, r.best_score
-            FROM ratings r
-            JOIN players p ON r.player_id = p.id
-            ORDER BY r.score DESC
-            LIMIT ?
-        ''', (limit,))
-
-        leaderboard = []
-        for row in cursor.fetchall():
-            leaderboard.append({
-                'username': row[0],
-                'score': row[1],
-                'games_played': row[2],
-                'wins': row[3],
-                'best_score': row[4]
-            })
-
-        return leaderboard
+        return [{
+            'username': row[0],
+            'score': row[1],
+            'games_played': row[2],
+            'wins': row[3],
+            'best_score': row[4]
+        } for row in self.conn.execute(self.SQL_LEADERBOARD, (limit,))]
+
+    def get_leaderboard_message(self, limit: int = 10) -> str:
+        """Получить готовое JSON-сообщение с таблицей лидеров (с кэшированием)"""
+        now = time.monotonic()
+        # data_version меняется после коммита любого другого соединения, в том числе
+        # из других процессов сервера - их записи тоже делают кэш устаревшим
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        cached = self.leaderboard_cache.get(limit)
+        if cached and cached[1] == version and now - cached[0] < self.LEADERBOARD_CACHE_TTL:
+            return cached[2]
+
+        message = json_dumps({
+            'type': 'leaderboard',
+            'leaderboard': self.get_leaderboard(limit)
+        })
+        self.leaderboard_cache[limit] = (now, version, message)
+        return message
 
     def add_achievement(self, username: str, achievement_name: str):
         """Добавить достижение игроку"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id FROM players WHERE username = ?', (username,))
-        result = cursor.fetchone()
+        result = self.conn.execute(self.SQL_PLAYER_ID, (username,)).fetchone()
 
         if result:
-            player_id = result[0]
-            cursor.execute('''
-                INSERT INTO achievements (player_id, achievement_name)
-                VALUES (?, ?)
-            ''', (player_id, achievement_name))
-            self.conn.commit()
+            with self.conn:
+                self.conn.execute(self.SQL_INSERT_ACHIEVEMENT, (result[0], achievement_name))
+
+
+class Player:
+    """Данные подключенного игрока"""
+
+    # Фиксированный набор полей: доступ по индексу слота вместо поиска в dict
+    __slots__ = ('x', 'y', 'role', 'color', 'score', 'power_mode', 'power_timer', 'lives',
+                 'websocket', 'outbox', 'writer', 'features', 'name', 'voice_chat', 'muted',
+                 'total_score', 'games_played', 'wins', 'needs_full_state', 'view', 'announced',
+                 'color_index', 'static_dirty', 'sending')
+
+    # Поля игрока, которые отправляются клиентам
+    STATE_FIELDS = ('x', 'y', 'role', 'color', 'score', 'power_mode', 'lives', 'name', 'voice_chat', 'muted')
+    # Часто меняющиеся поля сверяются с view на каждой рассылке, остальные -
+    # только после того, как изменивший их код пометил игрока static_dirty
+    DYNAMIC_FIELDS = ('x', 'y', 'score', 'power_mode')
+
+    def __init__(self, player_id: str, websocket, x: int, y: int, color: List[int],
+                 queue_size: int = 8, color_index: Optional[int] = None):
+        self.x = x
+        self.y = y
+        self.role = 'ghost'
+        self.color = color
+        # Номер цвета в палитре призраков (None - цвет не из палитры)
+        self.color_index = color_index
+        self.score = 0
+        self.power_mode = False
+        self.power_timer = 0
+        self.lives = 3
+        self.websocket = websocket
+        self.outbox = asyncio.Queue(maxsize=queue_size)
+        self.writer = None
+        # Сообщение уже взято из очереди, но еще не записано в сокет
+        self.sending = False
+        self.features = set()
+        self.name = f'Player{player_id}'
+        self.voice_chat = True
+        self.muted = False
+        self.total_score = 0
+        self.games_played = 0
+        self.wins = 0
+        # Клиенту с 'delta' нужен полный снимок: он еще не получал его или потерял сообщение
+        self.needs_full_state = True
+        # Состояние для рассылки: один dict на все время игры, обновляется на месте
+        self.view = self.to_state()
+        # Игрок уже попал в рассылку - дальше в 'delta' идут только его изменения
+        self.announced = False
+        # Изменились роль, цвет, жизни, имя или настройки голоса
+        self.static_dirty = False
+
+    def to_state(self) -> Dict:
+        """Поля игрока, которые отправляются клиентам"""
+        return {key: getattr(self, key) for key in self.STATE_FIELDS}
+
+    def refresh_view(self) -> Dict:
+        """Обновление view текущими значениями; возвращает изменившиеся поля"""
+        view = self.view
+        changed = {}
+        fields = self.STATE_FIELDS if self.static_dirty else self.DYNAMIC_FIELDS
+        self.static_dirty = False
+        for key in fields:
+            value = getattr(self, key)
+            if view[key] != value:
+                view[key] = changed[key] = value
+        return changed
 
 
 class WebSocketPacmanServer:
+    # Размер клетки сетки стен и минимальное число стен, при котором сетка выгодна
+    WALL_GRID_CELL = 64
+    WALL_GRID_MIN_WALLS = 16
+    # Клетка сетки снежинок: больше, чем половина Пакмена плюс размер снежинки,
+    # поэтому достаточно проверить клетку Пакмена и восемь соседних
+    DOT_GRID_CELL = 32
+
+    # Полуразмеры хитбоксов Пакмена, призрака и сосульки (у снежинок - поле 'size')
+    PACMAN_HALF_SIZE = 15
+    GHOST_HALF_SIZE = 15
+    ICICLE_HALF_SIZE = 5
+
+    # Очки за снежинку по ее типу (по умолчанию - как за обычную)
+    SNOWFLAKE_POINTS = {'regular': 10, 'crystal': 15, 'star': 20}
+
+    # Частота рассылки состояния (тиков в секунду) и длина очереди отправки клиента
+    TICK_RATE = 30
+    SEND_QUEUE_SIZE = 8
+
+    # Сообщения короче этого размера не сжимаются (мелкие голосовые пакеты)
+    COMPRESSION_MIN_SIZE = 256
+
+    # Пока в буфере сокета меньше этого объема, рассылка пишет кадры напрямую
+    WRITE_BUFFER_LIMIT = 64 * 1024
+
+    # Одновременных отправок из очередей не больше SEND_CONCURRENCY; клиент,
+    # не принявший сообщение за SEND_TIMEOUT секунд, отключается
+    SEND_CONCURRENCY = 64
+    SEND_TIMEOUT = 1.0
+
     def __init__(self, host: str = 'localhost', port: int = 5556, name: str = 'WinterPacmanServer'):
         self.host = host
         self.port = port
         self.server_name = name
         self.connected_clients: Set[websockets.WebSocketServerProtocol] = set()
-        self.players: Dict[str, Dict] = {}
+        self.players: Dict[str, Player] = {}
+        # Пары (id, игрок) в порядке подключения для циклов рассылки на каждом тике;
+        # обновляются при подключении и отключении, а не собираются заново
+        self.player_entries: List[tuple] = []
         self.pacman_player_id: Optional[str] = None
+        # Состояния игроков для рассылки (Player.view) и id ушедших с прошлой рассылки
+        self.player_views: Dict[str, Dict] = {}
+        self.removed_players: List[str] = []
+        # Список (id, игрок) призраков для проверки столкновений; None - пересобрать
+        self.ghosts_cache: Optional[List[tuple]] = None
         self.player_counter = 0
         self.db = DatabaseManager()
+        # Обновления рейтингов (username, score, is_win) пишутся в базу фоновой задачей db_worker
+        self.db_queue: asyncio.Queue = asyncio.Queue()
 
         # Зимние цвета
         self.ghost_colors_available = [
@@ -179,25 +452,64 @@ class WebSocketPacmanServer:
             [176, 224, 230],  # Пудрово-голубой
             [255, 250, 205]  # Снежно-желтый
         ]
-        self.used_ghost_colors: Set[tuple] = set()
+        # Битовая маска свободных цветов: младший бит - первый свободный цвет
+        self.free_color_mask = (1 << len(self.ghost_colors_available)) - 1
+        self.color_cycle = itertools.cycle(range(len(self.ghost_colors_available)))
 
         # Игровое поле и карты
         self.current_map = 0
         self.maps = self.generate_winter_maps()
 
+        # Стены, декоративные снежинки и постоянные поля карты не меняются - сериализуем
+        # их один раз в начало сообщения game_state, к которому дописывается динамика;
+        # клиентам со 'static_map' оформление карты уходит отдельным сообщением 'map'
+        for map_id, game_map in enumerate(self.maps):
+            map_static = {
+                'walls': game_map['walls'],
+                'snowflakes': game_map['snowflakes'],
+                'map_name': game_map['name'],
+                'map_theme': game_map['background']
+            }
+            map_fields = {'current_map': map_id, 'season': 'winter', 'time_of_day': 'night'}
+            game_map['state_prefix'] = json_dumps_bytes({'type': 'game_state', **map_static, **map_fields})[:-1]
+            game_map['light_state_prefix'] = json_dumps_bytes({'type': 'game_state', **map_fields})[:-1]
+            game_map['map_message'] = json_dumps_bytes({'type': 'map', 'current_map': map_id, **map_static})
+            # Столбцы по индексу снежинки/сосульки: 1 - на поле, 0 - съедена; очки за снежинку.
+            # Хранятся в карте, поэтому съеденное сохраняется при смене карт
+            game_map['dots_present'] = bytearray(b'\x01' * len(game_map['dots']))
+            game_map['pellets_present'] = bytearray(b'\x01' * len(game_map['power_pellets']))
+            game_map['dot_points'] = [
+                self.SNOWFLAKE_POINTS.get(dot.get('type'), 10) for dot in game_map['dots']
+            ]
+
         # Таймер восстановления очков
         self.dot_respawn_interval = 30
-        self.last_respawn_time = datetime.now()
+        self.last_respawn_time = time.monotonic()
+
+        # Состояние изменилось с последней рассылки - разошлем его на ближайшем тике
+        self.state_changed = False
+        self.send_semaphore = asyncio.Semaphore(self.SEND_CONCURRENCY)
+        # Общая часть состояния из прошлой рассылки - база для сообщений 'delta'
+        self.last_shared_state: Optional[Dict] = None
+
+        # Обработчики входящих сообщений по типу
+        self.message_handlers = {
+            'position': self.on_position,
+            'voice_chat': self.on_voice_chat,
+            'voice_audio': self.on_voice_audio,
+            'mute_player': self.on_mute_player,
+            'change_map': self.on_change_map,
+            'get_leaderboard': self.on_get_leaderboard,
+            'get_player_stats': self.on_get_player_stats,
+            'hello': self.on_hello
+        }
 
         # Голосовой чат
         self.voice_chat_enabled = True
         self.voice_data_buffer = {}
 
         # Инициализация текущей карты
-        self.dots = self.maps[self.current_map]['dots']
-        self.power_pellets = self.maps[self.current_map]['power_pellets']
-        self.walls = self.maps[self.current_map]['walls']
-        self.snowflakes = self.maps[self.current_map]['snowflakes']
+        self.setup_map(self.current_map)
 
         print(f"🎮 WebSocket Winter Pacman Server - {name}")
         print(f"📍 Хост: {self.host}")
@@ -210,18 +522,70 @@ class WebSocketPacmanServer:
         print("🌙 Ночная зимняя тематика")
         print("=" * 50)
 
+    def setup_map(self, map_id: int):
+        """Активация карты и предрасчет данных для проверки столкновений"""
+        self.current_map = map_id
+        current_map = self.maps[map_id]
+        self.dots = current_map['dots']
+        self.power_pellets = current_map['power_pellets']
+        self.walls = current_map['walls']
+        self.snowflakes = current_map['snowflakes']
+        self.dots_present = current_map['dots_present']
+        self.pellets_present = current_map['pellets_present']
+        self.dot_points = current_map['dot_points']
+        self.current_state_prefix = current_map['state_prefix']
+        self.current_light_state_prefix = current_map['light_state_prefix']
+        self.current_map_message = current_map['map_message']
+        # Точки появления призраков выдаются по кругу - призраки не скапливаются в одной
+        self.ghost_spawn_cycle = itertools.cycle(current_map['ghost_spawns'])
+        # Изменения относительно прошлой карты не считаются - следующая рассылка полная
+        self.last_shared_state = None
+
+        # Границы стен (left, right, top, bottom); self.walls остается для отправки клиентам.
+        # Дробные координаты (круговая арена) округляются наружу до целых:
+        # сравнение int с int дешевле смешанного, а стена не становится тоньше
+        self.wall_rects = [
+            (math.floor(wall['x']), math.ceil(wall['x'] + wall['width']),
+             math.floor(wall['y']), math.ceil(wall['y'] + wall['height']))
+            for wall in self.walls
+        ]
+
+        # На картах с малым числом стен полный перебор дешевле сетки
+        if len(self.wall_rects) >= self.WALL_GRID_MIN_WALLS:
+            self.wall_grid = build_grid(self.wall_rects, self.WALL_GRID_CELL)
+        else:
+            self.wall_grid = None
+
+        # Индексы снежинок и сосулек по клеткам; съеденные остаются в сетке и пропускаются по маске
+        self.dot_grid = build_point_grid(self.dots, self.DOT_GRID_CELL)
+        self.pellet_grid = build_point_grid(self.power_pellets, self.DOT_GRID_CELL, self.ICICLE_HALF_SIZE)
+        # Несъеденные снежинки и сосульки для рассылки; None - пересобрать
+        self.active_dots: Optional[List[Dict]] = None
+        self.active_pellets: Optional[List[Dict]] = None
+
+    def get_nearby_buckets(self, grid: Dict[tuple, tuple], x: int, y: int) -> List[tuple]:
+        """Клетки (границы, объекты) сетки вокруг точки (x, y): ее клетка и восемь соседних"""
+        cell_x, cell_y = int(x // self.DOT_GRID_CELL), int(y // self.DOT_GRID_CELL)
+        nearby = []
+        for cx in range(cell_x - 1, cell_x + 2):
+            for cy in range(cell_y - 1, cell_y + 2):
+                bucket = grid.get((cx, cy))
+                if bucket:
+                    nearby.append(bucket)
+        return nearby
+
     def generate_snowflakes(self, count: int = 50):
         """Генерация снежинок для зимней тематики"""
-        snowflakes = []
-        for _ in range(count):
-            snowflakes.append({
-                'x': random.randint(50, 950),
-                'y': random.randint(50, 650),
-                'size': random.randint(2, 4),
-                'speed': random.uniform(0.5, 2.0),
-                'brightness': random.uniform(0.7, 1.0)
-            })
-        return snowflakes
+        # Все значения строятся из одного вызова random() вместо цепочек
+        # randint -> randrange -> _randbelow; распределения те же
+        rnd = random.random
+        return [{
+            'x': 50 + int(rnd() * 901),
+            'y': 50 + int(rnd() * 601),
+            'size': 2 + int(rnd() * 3),
+            'speed': 0.5 + 1.5 * rnd(),
+            'brightness': 0.7 + 0.3 * rnd()
+        } for _ in range(count)]
 
     def generate_winter_maps(self):
         """Генерация 5 зимних карт"""
@@ -411,18 +775,17 @@ class WebSocketPacmanServer:
 
     def generate_snowflakes_for_map(self, map_id):
         """Генерация снежинок для конкретной карты"""
-        snowflakes = []
         count = [120, 100, 150, 110, 130][map_id - 1]  # Разное количество для каждой карты
 
-        for _ in range(count):
-            snowflakes.append({
-                'x': random.randint(80, 920),
-                'y': random.randint(80, 620),
-                'size': random.randint(2, 5),
-                'brightness': random.uniform(0.6, 1.0),
-                'type': random.choice(['regular', 'crystal', 'star'])
-            })
-        return snowflakes
+        rnd = random.random
+        types = ('regular', 'crystal', 'star')
+        return [{
+            'x': 80 + int(rnd() * 841),
+            'y': 80 + int(rnd() * 541),
+            'size': 2 + int(rnd() * 4),
+            'brightness': 0.6 + 0.4 * rnd(),
+            'type': types[int(rnd() * 3)]
+        } for _ in range(count)]
 
     def generate_icicles_for_map(self, map_id):
         """Генерация сосулек (силовые точки)"""
@@ -441,27 +804,20 @@ class WebSocketPacmanServer:
 
     def check_wall_collision(self, x: int, y: int, player_size: int = 30) -> bool:
         """Проверка столкновения со стенами"""
-        player_rect = {
-            'left': x - player_size // 2,
-            'right': x + player_size // 2,
-            'top': y - player_size // 2,
-            'bottom': y + player_size // 2
-        }
+        half_size = player_size // 2
+        left, right = x - half_size, x + half_size
+        top, bottom = y - half_size, y + half_size
 
-        for wall in self.walls:
-            wall_rect = {
-                'left': wall['x'],
-                'right': wall['x'] + wall['width'],
-                'top': wall['y'],
-                'bottom': wall['y'] + wall['height']
-            }
+        if self.wall_grid is None:
+            return aabb_hit_any(left, right, top, bottom, self.wall_rects)
 
-            # Проверка пересечения прямоугольников
-            if (player_rect['right'] > wall_rect['left'] and
-                    player_rect['left'] < wall_rect['right'] and
-                    player_rect['bottom'] > wall_rect['top'] and
-                    player_rect['top'] < wall_rect['bottom']):
-                return True
+        # Проверяем только стены из клеток, которые задевает игрок
+        cell = self.WALL_GRID_CELL
+        for cx in range(int(left // cell), int(right // cell) + 1):
+            for cy in range(int(top // cell), int(bottom // cell) + 1):
+                rects = self.wall_grid.get((cx, cy))
+                if rects and aabb_hit_any(left, right, top, bottom, rects):
+                    return True
 
         return False
 
@@ -482,43 +838,51 @@ class WebSocketPacmanServer:
         # Если ничего не помогает, остаемся на месте
         return old_x, old_y
 
-    def get_ghost_color(self) -> List[int]:
-        """Получение уникального зимнего цвета для призрака"""
-        available_colors = [c for c in self.ghost_colors_available
-                            if tuple(c) not in self.used_ghost_colors]
-        if available_colors:
-            color = available_colors[0]
-            self.used_ghost_colors.add(tuple(color))
-            return color
+    def get_ghost_color_index(self) -> int:
+        """Номер уникального зимнего цвета для призрака в ghost_colors_available"""
+        mask = self.free_color_mask
+        if mask:
+            i = (mask & -mask).bit_length() - 1
+            self.free_color_mask = mask & ~(1 << i)
+            return i
         else:
-            return random.choice(self.ghost_colors_available)
+            return next(self.color_cycle)
 
     def assign_roles(self):
         """Назначение ролей игрокам"""
-        if not self.players:
-            return
+        # Вызывается после любого изменения состава игроков - список призраков устарел
+        self.ghosts_cache = None
 
-        player_ids = list(self.players.keys())
+        # Пакмен на месте - новые игроки уже созданы призраками, менять нечего
+        if not self.players or self.pacman_player_id in self.players:
+            return
 
-        # Если Пакмена нет, назначаем случайного игрока
-        if self.pacman_player_id is None or self.pacman_player_id not in self.players:
-            if player_ids:
-                self.pacman_player_id = random.choice(player_ids)
-                logger.info(f"🎯 Игрок {self.pacman_player_id} стал Снежным Пакменом!")
+        # Пакмена нет, назначаем случайного игрока
+        self.pacman_player_id = random.choice(list(self.players))
+        logger.info("🎯 Игрок %s стал Снежным Пакменом!", self.pacman_player_id)
 
-        # Назначаем роли и цвета
-        for player_id in player_ids:
+        # Назначаем роли и цвета; бывший Пакмен, если он в игре, становится призраком
+        for player_id, player in self.players.items():
             if player_id == self.pacman_player_id:
-                self.players[player_id]['role'] = 'pacman'
-                self.players[player_id]['color'] = [255, 255, 0]  # Желтый (снежный шар)
-                if 'lives' not in self.players[player_id]:
-                    self.players[player_id]['lives'] = 3
-                if 'score' not in self.players[player_id]:
-                    self.players[player_id]['score'] = 0
-            else:
-                self.players[player_id]['role'] = 'ghost'
-                if 'color' not in self.players[player_id]:
-                    self.players[player_id]['color'] = self.get_ghost_color()
+                player.role = 'pacman'
+                player.color = [255, 255, 0]  # Желтый (снежный шар)
+                # Цвет призрака возвращается в палитру
+                if player.color_index is not None:
+                    self.free_color_mask |= 1 << player.color_index
+                    player.color_index = None
+                player.static_dirty = True
+            elif player.role == 'pacman':
+                player.role = 'ghost'
+                player.static_dirty = True
+
+    def get_ghosts(self) -> List[tuple]:
+        """Призраки (id, игрок); позиции читаются из объектов игроков"""
+        if self.ghosts_cache is None:
+            self.ghosts_cache = [
+                (player_id, player) for player_id, player in self.players.items()
+                if player.role == 'ghost'
+            ]
+        return self.ghosts_cache
 
     async def handle_client(self, websocket: websockets.WebSocketServerProtocol, path: str = None):
         """Обработка подключения клиента"""
@@ -531,146 +895,271 @@ class WebSocketPacmanServer:
         # Начальная позиция в зависимости от роли
         current_map = self.maps[self.current_map]
 
-        self.players[player_id] = {
-            'x': current_map['pacman_spawn'][0],
-            'y': current_map['pacman_spawn'][1],
-            'role': 'ghost',
-            'color': self.get_ghost_color(),
-            'score': 0,
-            'power_mode': False,
-            'power_timer': 0,
-            'lives': 3,
-            'websocket': websocket,
-            'name': f'Player{player_id}',
-            'voice_chat': True,
-            'muted': False,
-            'total_score': 0,
-            'games_played': 0,
-            'wins': 0
-        }
+        color_index = self.get_ghost_color_index()
+        self.players[player_id] = Player(
+            player_id, websocket,
+            current_map['pacman_spawn'][0], current_map['pacman_spawn'][1],
+            self.ghost_colors_available[color_index], self.SEND_QUEUE_SIZE, color_index
+        )
+        self.player_views[player_id] = self.players[player_id].view
+        self.player_entries.append((player_id, self.players[player_id]))
 
         # Перераспределяем роли
         self.assign_roles()
+        self.state_changed = True
 
-        logger.info(f"🎮 Подключен игрок {player_id}")
+        logger.info("🎮 Подключен игрок %s", player_id)
 
         try:
-            # Отправляем начальное состояние
+            # Отправляем начальное состояние, затем запускаем отправку из очереди
             await self.send_game_state(player_id)
+            self.players[player_id].writer = asyncio.create_task(
+                self.client_writer(player_id, websocket, self.players[player_id].outbox)
+            )
 
             # Обрабатываем сообщения от клиента
             async for message in websocket:
-                await self.handle_message(player_id, message)
+                if isinstance(message, bytes):
+                    await self.handle_binary_message(player_id, message)
+                else:
+                    await self.handle_message(player_id, message)
 
         except websockets.exceptions.ConnectionClosed:
-            logger.info(f"🔌 Игрок {player_id} отключился")
+            logger.info("🔌 Игрок %s отключился", player_id)
         except Exception as e:
-            logger.error(f"❌ Ошибка с игроком {player_id}: {e}")
+            logger.error("❌ Ошибка с игроком %s: %s", player_id, e)
         finally:
             # Очистка при отключении
             await self.cleanup_player(player_id)
 
-    async def handle_message(self, player_id: str, message: str):
-        """Обработка сообщения от клиента"""
+    async def client_writer(self, player_id: str, websocket: websockets.WebSocketServerProtocol,
+                            outbox: asyncio.Queue):
+        """Отправка сообщений клиенту из его очереди"""
+        player_data = self.players[player_id]
         try:
-            data = json.loads(message)
-
-            if data['type'] == 'position':
-                new_x = data['position']['x']
-                new_y = data['position']['y']
-
-                # Обновляем имя если передано
-                if 'name' in data['position']:
-                    self.players[player_id]['name'] = data['position']['name']
-
-                # Получаем старые координаты
-                old_x = self.players[player_id]['x']
-                old_y = self.players[player_id]['y']
-
-                # Проверяем столкновение со стенами и получаем валидную позицию
-                valid_x, valid_y = self.get_valid_position(old_x, old_y, new_x, new_y)
-
-                # Обновляем позицию
-                self.players[player_id]['x'] = valid_x
-                self.players[player_id]['y'] = valid_y
-
-                # Проверяем столкновения (только для Пакмена)
-                if self.players[player_id]['role'] == 'pacman':
-                    await self.check_snowflake_collision(player_id, valid_x, valid_y)
-                    await self.check_icicle_collision(player_id, valid_x, valid_y)
-                    await self.check_ghost_collision(player_id, valid_x, valid_y)
-
-                # Обновляем таймер силы
-                if self.players[player_id]['power_mode']:
-                    self.players[player_id]['power_timer'] -= 1
-                    if self.players[player_id]['power_timer'] <= 0:
-                        self.players[player_id]['power_mode'] = False
-
-            elif data['type'] == 'voice_chat':
-                # Включение/выключение голосового чата
-                self.players[player_id]['voice_chat'] = data['enabled']
-                logger.info(f"🎤 Игрок {player_id} {'включил' if data['enabled'] else 'выключил'} голосовой чат")
-
-            elif data['type'] == 'voice_audio':
-                # Пересылка голосовых данных другим игрокам
-                if self.players[player_id]['voice_chat'] and not self.players[player_id]['muted']:
-                    await self.broadcast_voice_audio(player_id, data['audio_data'], data['sequence'])
-
-            elif data['type'] == 'mute_player':
-                # Заглушить/разглушить игрока
-                target_player = data['player_id']
-                if target_player in self.players:
-                    self.players[target_player]['muted'] = data['muted']
-                    logger.info(f"🔇 Игрок {player_id} {'заглушил' if data['muted'] else 'разглушил'} {target_player}")
-
-            elif data['type'] == 'change_map':
-                # Смена карты
-                new_map = data['map_id']
-                if 0 <= new_map < len(self.maps):
-                    self.current_map = new_map
-                    self.dots = self.maps[self.current_map]['dots']
-                    self.power_pellets = self.maps[self.current_map]['power_pellets']
-                    self.walls = self.maps[self.current_map]['walls']
-                    self.snowflakes = self.maps[self.current_map]['snowflakes']
-
-                    # Перемещаем всех игроков на новые позиции спавна
-                    current_map_data = self.maps[self.current_map]
-                    for pid, player in self.players.items():
-                        if player['role'] == 'pacman':
-                            player['x'], player['y'] = current_map_data['pacman_spawn']
-                        else:
-                            spawn_pos = random.choice(current_map_data['ghost_spawns'])
-                            player['x'], player['y'] = spawn_pos
+            while True:
+                message = await outbox.get()
+                # Пока send не вернулся (включая ожидание семафора), очередь пуста,
+                # но более новое сообщение не должно обогнать это прямой записью в транспорт
+                player_data.sending = True
+                try:
+                    async with self.send_semaphore:
+                        await asyncio.wait_for(websocket.send(message), self.SEND_TIMEOUT)
+                finally:
+                    player_data.sending = False
+        except asyncio.TimeoutError:
+            # Медленный клиент: закрываем соединение, игрока очистит цикл приема сообщений
+            logger.warning("🐢 Игрок %s не успевает принимать данные - отключаем", player_id)
+            await websocket.close()
+        except websockets.exceptions.ConnectionClosed:
+            pass
 
-                    logger.info(f"🗺️ Смена карты на: {self.maps[self.current_map]['name']}")
+    def broadcast_message(self, recipients, payload):
+        """Рассылка одинакового JSON-сообщения; сжатие выполняется один раз на всех
 
-            elif data['type'] == 'get_leaderboard':
-                # Отправка таблицы лидеров
-                leaderboard = self.db.get_leaderboard()
-                await self.send_leaderboard(player_id, leaderboard)
+        payload - str или UTF-8 bytes, без сжатия уходит текстовым кадром
+        """
+        plain = []
+        compressed = []
+        for player_data in recipients:
+            if 'zlib' in player_data.features and len(payload) >= self.COMPRESSION_MIN_SIZE:
+                compressed.append(player_data)
+            else:
+                plain.append(player_data)
+
+        if plain:
+            self.send_to_all(plain, payload, text=True)
+        if compressed:
+            self.send_to_all(compressed, compress_payload(payload))
+
+    def send_to_all(self, recipients, message, text: bool = False):
+        """Отправка одного сообщения нескольким клиентам; кадр строится один раз
+
+        bytes с text=True - готовый UTF-8 текст, который уходит текстовым кадром
+        """
+        frame = None
+        queued = None
+        for player_data in recipients:
+            transport = self.direct_transport(player_data)
+            if transport is None:
+                # websocket.send отправит bytes бинарным кадром - для очереди текст декодируется
+                if queued is None:
+                    queued = message.decode() if text and isinstance(message, bytes) else message
+                self.enqueue_message(player_data, queued)
+            else:
+                if frame is None:
+                    frame = encode_frame(message, text)
+                transport.write(frame)
+
+    def direct_transport(self, player_data: Player):
+        """Транспорт клиента, если сообщение можно записать сразу, минуя очередь"""
+        if player_data.sending or not player_data.outbox.empty():
+            # Более ранние сообщения в очереди или в отправке - порядок нарушать нельзя
+            return None
+        websocket = player_data.websocket
+        # С permessage-deflate кадр должна сжать библиотека: готовый кадр ушел бы несжатым.
+        # Расширения лежат в websocket.protocol (websockets >= 14) или в самом соединении
+        if getattr(getattr(websocket, 'protocol', websocket), 'extensions', None):
+            return None
+        transport = getattr(websocket, 'transport', None)
+        if (transport is None or transport.is_closing() or websocket.state is not State.OPEN or
+                transport.get_write_buffer_size() > self.WRITE_BUFFER_LIMIT):
+            # Клиент не успевает принимать - сообщение подождет в очереди
+            return None
+        return transport
+
+    def enqueue_message(self, player_data: Player, message):
+        """Постановка сообщения в очередь отправки клиента"""
+        outbox = player_data.outbox
+        if outbox.full():
+            # Клиент не успевает принимать - выбрасываем самое старое сообщение,
+            # следующий снимок состояния все равно содержит актуальные данные
+            outbox.get_nowait()
+            # Цепочка изменений прервана - клиенту с 'delta' нужен полный снимок
+            player_data.needs_full_state = True
+        outbox.put_nowait(message)
 
-            elif data['type'] == 'get_player_stats':
-                # Отправка статистики игрока
-                if 'username' in data:
-                    stats = self.db.get_player_rating(data['username'])
-                    await self.send_player_stats(player_id, stats)
+    async def handle_message(self, player_id: str, message: str):
+        """Обработка сообщения от клиента"""
+        try:
+            data = json_loads(message)
 
-            # Рассылаем обновленное состояние всем клиентам
-            await self.broadcast_game_state()
+            handler = self.message_handlers.get(data['type'])
+            if handler:
+                await handler(player_id, data)
 
         except json.JSONDecodeError as e:
-            logger.error(f"❌ Ошибка JSON от игрока {player_id}: {e}")
+            logger.error("❌ Ошибка JSON от игрока %s: %s", player_id, e)
+
+    async def on_position(self, player_id: str, data: Dict):
+        """Обновление позиции игрока"""
+        player = self.players[player_id]
+        new_x = data['position']['x']
+        new_y = data['position']['y']
+
+        # Обновляем имя если передано
+        name_changed = False
+        if 'name' in data['position'] and data['position']['name'] != player.name:
+            player.name = data['position']['name']
+            player.static_dirty = True
+            name_changed = True
+
+        # Получаем старые координаты
+        old_x = player.x
+        old_y = player.y
+
+        if new_x == old_x and new_y == old_y:
+            # Игрок стоит на месте: стены и снежинки проверять незачем,
+            # а рассылка нужна только если что-то изменилось
+            changed = name_changed
+            if player.role == 'pacman':
+                # Призрак мог сам подойти к стоящему Пакмену
+                changed = await self.check_ghost_collision(player_id, old_x, old_y) or changed
+            changed = self.update_power_timer(player) or changed
+            if changed:
+                self.state_changed = True
+            return
 
-    async def send_leaderboard(self, player_id: str, leaderboard: List[Dict]):
+        # Проверяем столкновение со стенами и получаем валидную позицию
+        valid_x, valid_y = self.get_valid_position(old_x, old_y, new_x, new_y)
+
+        # Обновляем позицию
+        player.x = valid_x
+        player.y = valid_y
+
+        # Проверяем столкновения (только для Пакмена)
+        if player.role == 'pacman':
+            await self.check_snowflake_collision(player_id, valid_x, valid_y)
+            await self.check_icicle_collision(player_id, valid_x, valid_y)
+            await self.check_ghost_collision(player_id, valid_x, valid_y)
+
+        # Обновляем таймер силы
+        self.update_power_timer(player)
+
+        # Обновленное состояние уйдет всем клиентам на ближайшем тике
+        self.state_changed = True
+
+    async def on_voice_chat(self, player_id: str, data: Dict):
+        """Включение/выключение голосового чата"""
+        self.players[player_id].voice_chat = data['enabled']
+        self.players[player_id].static_dirty = True
+        logger.info("🎤 Игрок %s %s голосовой чат", player_id, 'включил' if data['enabled'] else 'выключил')
+        self.state_changed = True
+
+    async def on_voice_audio(self, player_id: str, data: Dict):
+        """Пересылка голосовых данных другим игрокам"""
+        player = self.players[player_id]
+        if player.voice_chat and not player.muted:
+            await self.broadcast_voice_audio(player_id, data['audio_data'], data['sequence'])
+
+    async def on_mute_player(self, player_id: str, data: Dict):
+        """Заглушить/разглушить игрока"""
+        target_player = data['player_id']
+        if target_player in self.players:
+            self.players[target_player].muted = data['muted']
+            self.players[target_player].static_dirty = True
+            logger.info("🔇 Игрок %s %s %s", player_id, 'заглушил' if data['muted'] else 'разглушил', target_player)
+            self.state_changed = True
+
+    async def on_change_map(self, player_id: str, data: Dict):
+        """Смена карты"""
+        new_map = data['map_id']
+        if 0 <= new_map < len(self.maps):
+            self.setup_map(new_map)
+
+            # Перемещаем всех игроков на новые позиции спавна
+            current_map_data = self.maps[self.current_map]
+            for pid, player in self.players.items():
+                if player.role == 'pacman':
+                    player.x, player.y = current_map_data['pacman_spawn']
+                else:
+                    player.x, player.y = next(self.ghost_spawn_cycle)
+
+            logger.info("🗺️ Смена карты на: %s", self.maps[self.current_map]['name'])
+            self.state_changed = True
+
+    async def on_get_leaderboard(self, player_id: str, data: Dict):
+        """Отправка таблицы лидеров (сообщение уже сериализовано)"""
+        await self.send_leaderboard(player_id, self.db.get_leaderboard_message())
+
+    async def on_get_player_stats(self, player_id: str, data: Dict):
+        """Отправка статистики игрока"""
+        if 'username' in data:
+            stats = self.db.get_player_rating(data['username'])
+            await self.send_player_stats(player_id, stats)
+
+    async def on_hello(self, player_id: str, data: Dict):
+        """Клиент сообщает, какие расширения протокола он поддерживает"""
+        features = PROTOCOL_FEATURES.intersection(data.get('features', []))
+        self.players[player_id].features = set(features)
+        self.players[player_id].needs_full_state = True
+        await self.send_hello(player_id)
+
+    def update_power_timer(self, player: Player) -> bool:
+        """Отсчет таймера силы Пакмена (True, если сила закончилась)"""
+        if player.power_mode:
+            player.power_timer -= 1
+            if player.power_timer <= 0:
+                player.power_mode = False
+                return True
+        return False
+
+    async def handle_binary_message(self, player_id: str, message: bytes):
+        """Обработка бинарного кадра от клиента"""
+        if message[:1] == b'V' and len(message) > 1 + VOICE_HEADER.size:
+            # Голосовой кадр пересылается без base64 и JSON
+            player = self.players[player_id]
+            if player.voice_chat and not player.muted:
+                _, sequence = VOICE_HEADER.unpack_from(message, 1)
+                await self.broadcast_voice_audio(player_id, message[1 + VOICE_HEADER.size:], sequence)
+
+    async def send_leaderboard(self, player_id: str, message: str):
         """Отправка таблицы лидеров игроку"""
         if player_id in self.players:
-            message = {
-                'type': 'leaderboard',
-                'leaderboard': leaderboard
-            }
             try:
-                await self.players[player_id]['websocket'].send(json.dumps(message))
-            except:
+                await self.players[player_id].websocket.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                # Клиент уже отключился - его очистит цикл приема сообщений
                 pass
 
     async def send_player_stats(self, player_id: str, stats: Dict):
@@ -681,249 +1170,378 @@ class WebSocketPacmanServer:
                 'stats': stats
             }
             try:
-                await self.players[player_id]['websocket'].send(json.dumps(message))
-            except:
+                await self.players[player_id].websocket.send(json_dumps(message))
+            except websockets.exceptions.ConnectionClosed:
+                # Клиент уже отключился - его очистит цикл приема сообщений
                 pass
 
-    async def broadcast_voice_audio(self, sender_id: str, audio_data: str, sequence: int):
-        """Рассылка голосовых данных другим игрокам"""
-        tasks = []
-        for player_id, player_data in self.players.items():
-            if (player_id != sender_id and
-                    player_data['voice_chat'] and
-                    not player_data['muted'] and
-                    player_data['websocket'] in self.connected_clients):
-
-                message = {
-                    'type': 'voice_audio',
-                    'sender_id': sender_id,
-                    'sender_name': self.players[sender_id]['name'],
-                    'audio_data': audio_data,
-                    'sequence': sequence
-                }
+    async def send_hello(self, player_id: str):
+        """Подтверждение включенных расширений протокола"""
+        if player_id in self.players:
+            message = {
+                'type': 'hello',
+                'features': sorted(self.players[player_id].features)
+            }
+            try:
+                await self.players[player_id].websocket.send(json_dumps(message))
+            except websockets.exceptions.ConnectionClosed:
+                # Клиент уже отключился - его очистит цикл приема сообщений
+                pass
 
-                try:
-                    tasks.append(
-                        player_data['websocket'].send(json.dumps(message))
-                    )
-                except:
-                    pass
+    async def broadcast_voice_audio(self, sender_id: str, audio_data, sequence: int):
+        """Рассылка голосовых данных другим игрокам
 
-        # Отправляем всем подходящим клиентам
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        audio_data - сырые байты из бинарного кадра или base64-строка из JSON
+        """
+        listeners = [
+            player_data for player_id, player_data in self.player_entries
+            if (player_id != sender_id and
+                player_data.voice_chat and
+                not player_data.muted and
+                player_data.websocket in self.connected_clients)
+        ]
+        binary_listeners = [p for p in listeners if 'binary_voice' in p.features]
+        json_listeners = [p for p in listeners if 'binary_voice' not in p.features]
+
+        # Каждый формат сообщения готовится один раз на всех слушателей
+        if binary_listeners:
+            # В бинарный кадр пакет из JSON попадает только с base64-строкой и целым номером;
+            # некорректный пропускается для этих слушателей, отправитель не отключается
+            audio = None
+            if type(sequence) is int:
+                if isinstance(audio_data, bytes):
+                    audio = audio_data
+                elif isinstance(audio_data, str):
+                    try:
+                        audio = base64.b64decode(audio_data)
+                    except ValueError:
+                        pass
+            if audio is None:
+                logger.error("❌ Некорректные голосовые данные от игрока %s", sender_id)
+            else:
+                frame = b'V' + VOICE_HEADER.pack(int(sender_id), sequence & 0xFFFF) + audio
+                self.send_to_all(binary_listeners, frame)
+
+        if json_listeners:
+            if isinstance(audio_data, bytes):
+                audio_data = base64.b64encode(audio_data).decode()
+            payload = json_dumps({
+                'type': 'voice_audio',
+                'sender_id': sender_id,
+                'sender_name': self.players[sender_id].name,
+                'audio_data': audio_data,
+                'sequence': sequence
+            })
+            self.broadcast_message(json_listeners, payload)
 
     async def check_snowflake_respawn(self):
         """Проверка и восстановление снежинок"""
-        now = datetime.now()
-        if (now - self.last_respawn_time).total_seconds() >= self.dot_respawn_interval:
+        now = time.monotonic()
+        if now - self.last_respawn_time >= self.dot_respawn_interval:
             respawned = 0
-            for snowflake in self.dots:
-                if snowflake.get('eaten', False) and random.random() > 0.7:
-                    snowflake['eaten'] = False
+            dots_present = self.dots_present
+            for index, present in enumerate(dots_present):
+                if not present and random.random() > 0.7:
+                    dots_present[index] = 1
                     respawned += 1
 
-            for icicle in self.power_pellets:
-                if icicle['eaten'] and random.random() > 0.5:
-                    icicle['eaten'] = False
+            pellets_present = self.pellets_present
+            for index, present in enumerate(pellets_present):
+                if not present and random.random() > 0.5:
+                    pellets_present[index] = 1
                     respawned += 1
 
             if respawned > 0:
-                logger.info(f"🔄 Восстановлено {respawned} снежинок")
+                self.active_dots = None
+                self.active_pellets = None
+                logger.info("🔄 Восстановлено %s снежинок", respawned)
                 self.last_respawn_time = now
+                self.state_changed = True
 
     async def check_snowflake_collision(self, player_id: str, x: int, y: int):
         """Проверка столкновения со снежинкой"""
-        pacman_left, pacman_top = x - 15, y - 15
-        pacman_right, pacman_bottom = x + 15, y + 15
-
-        for snowflake in self.dots:
-            if not snowflake.get('eaten', False):
-                snowflake_left = snowflake['x'] - snowflake['size']
-                snowflake_right = snowflake['x'] + snowflake['size']
-                snowflake_top = snowflake['y'] - snowflake['size']
-                snowflake_bottom = snowflake['y'] + snowflake['size']
-
-                if (pacman_left < snowflake_right and pacman_right > snowflake_left and
-                        pacman_top < snowflake_bottom and pacman_bottom > snowflake_top):
-                    snowflake['eaten'] = True
-                    points = 10
-                    if snowflake.get('type') == 'crystal':
-                        points = 15
-                    elif snowflake.get('type') == 'star':
-                        points = 20
-
-                    self.players[player_id]['score'] += points
-                    logger.info(f"❄️ Пакмен собрал снежинку! +{points} очков")
+        half = self.PACMAN_HALF_SIZE
+        pacman_left, pacman_top = x - half, y - half
+        pacman_right, pacman_bottom = x + half, y + half
+        pacman = self.players[player_id]
+        dots_present = self.dots_present
+
+        for rects, indexes in self.get_nearby_buckets(self.dot_grid, x, y):
+            # Маска проверяется только у пересекающихся снежинок
+            i = aabb_first_hit(pacman_left, pacman_right, pacman_top, pacman_bottom, rects)
+            while i >= 0:
+                index = indexes[i]
+                if dots_present[index]:
+                    dots_present[index] = 0
+                    self.active_dots = None
+                    points = self.dot_points[index]
+                    pacman.score += points
+                    logger.info("❄️ Пакмен собрал снежинку! +%s очков", points)
+                i = aabb_first_hit(pacman_left, pacman_right, pacman_top, pacman_bottom, rects, i + 1)
 
     async def check_icicle_collision(self, player_id: str, x: int, y: int):
         """Проверка столкновения с сосулькой"""
-        pacman_left, pacman_top = x - 15, y - 15
-        pacman_right, pacman_bottom = x + 15, y + 15
-
-        for icicle in self.power_pellets:
-            if not icicle['eaten']:
-                icicle_left = icicle['x'] - 5
-                icicle_right = icicle['x'] + 5
-                icicle_top = icicle['y'] - 5
-                icicle_bottom = icicle['y'] + 5
-
-                if (pacman_left < icicle_right and pacman_right > icicle_left and
-                        pacman_top < icicle_bottom and pacman_bottom > icicle_top):
-                    icicle['eaten'] = True
-                    self.players[player_id]['power_mode'] = True
-                    self.players[player_id]['power_timer'] = 300
-                    logger.info(f"🧊 Пакмен активировал ледяную силу!")
-
-    async def check_ghost_collision(self, player_id: str, x: int, y: int):
-        """Проверка столкновения с призраками"""
-        pacman_left, pacman_top = x - 15, y - 15
-        pacman_right, pacman_bottom = x + 15, y + 15
-
-        power_mode = self.players[player_id]['power_mode']
-
-        for ghost_id, ghost_data in self.players.items():
-            if ghost_id != player_id and ghost_data['role'] == 'ghost':
-                ghost_left = ghost_data['x'] - 15
-                ghost_right = ghost_data['x'] + 15
-                ghost_top = ghost_data['y'] - 15
-                ghost_bottom = ghost_data['y'] + 15
-
-                if (pacman_left < ghost_right and pacman_right > ghost_left and
-                        pacman_top < ghost_bottom and pacman_bottom > ghost_top):
+        half = self.PACMAN_HALF_SIZE
+        pacman_left, pacman_top = x - half, y - half
+        pacman_right, pacman_bottom = x + half, y + half
+        pacman = self.players[player_id]
+        pellets_present = self.pellets_present
+
+        for rects, indexes in self.get_nearby_buckets(self.pellet_grid, x, y):
+            i = aabb_first_hit(pacman_left, pacman_right, pacman_top, pacman_bottom, rects)
+            while i >= 0:
+                index = indexes[i]
+                if pellets_present[index]:
+                    pellets_present[index] = 0
+                    self.active_pellets = None
+                    pacman.power_mode = True
+                    pacman.power_timer = 300
+                    logger.info("🧊 Пакмен активировал ледяную силу!")
+                i = aabb_first_hit(pacman_left, pacman_right, pacman_top, pacman_bottom, rects, i + 1)
+
+    async def check_ghost_collision(self, player_id: str, x: int, y: int) -> bool:
+        """Проверка столкновения с призраками (True, если оно было)"""
+        # Хитбокс Пакмена, расширенный на полуразмер призрака: пересечение хитбоксов
+        # равносильно попаданию центра призрака внутрь расширенного прямоугольника
+        reach = self.PACMAN_HALF_SIZE + self.GHOST_HALF_SIZE
+        reach_left, reach_right = x - reach, x + reach
+        reach_top, reach_bottom = y - reach, y + reach
+
+        pacman = self.players[player_id]
+        power_mode = pacman.power_mode
+        collided = False
+
+        # Роль перепроверяется: если Пакмен замерз, роли переназначаются прямо в цикле
+        for ghost_id, ghost_data in self.get_ghosts():
+            if ghost_id != player_id and ghost_data.role == 'ghost':
+                if reach_left < ghost_data.x < reach_right and reach_top < ghost_data.y < reach_bottom:
+                    collided = True
 
                     if power_mode:
                         # Пакмен замораживает призрака
-                        logger.info(f"❄️ Пакмен заморозил призрака {ghost_id}!")
-                        current_map = self.maps[self.current_map]
-                        spawn_pos = random.choice(current_map['ghost_spawns'])
-                        self.players[ghost_id]['x'] = spawn_pos[0]
-                        self.players[ghost_id]['y'] = spawn_pos[1]
-                        self.players[player_id]['score'] += 200
+                        logger.info("❄️ Пакмен заморозил призрака %s!", ghost_id)
+                        ghost_data.x, ghost_data.y = next(self.ghost_spawn_cycle)
+                        pacman.score += 200
                     else:
                         # Призрак ловит Пакмена
-                        logger.info(f"👻 Призрак {ghost_id} поймал Пакмена!")
-                        self.players[player_id]['lives'] -= 1
+                        logger.info("👻 Призрак %s поймал Пакмена!", ghost_id)
+                        pacman.lives -= 1
+                        pacman.static_dirty = True
 
-                        if self.players[player_id]['lives'] <= 0:
+                        if pacman.lives <= 0:
                             # Пакмен умер - ищем нового
-                            logger.info(f"💀 Пакмен замерз! Ищем нового игрока...")
+                            logger.info("💀 Пакмен замерз! Ищем нового игрока...")
                             old_pacman = player_id
                             self.pacman_player_id = None
 
                             # Сохраняем статистику
-                            if 'name' in self.players[old_pacman]:
-                                username = self.players[old_pacman]['name']
-                                score = self.players[old_pacman]['score']
-                                self.db.update_player_rating(username, score, False)
+                            self.db_queue.put_nowait((pacman.name, pacman.score, False))
 
                             self.assign_roles()
 
                             # Телепортируем бывшего Пакмена как призрака
                             if old_pacman in self.players:
-                                current_map = self.maps[self.current_map]
-                                spawn_pos = random.choice(current_map['ghost_spawns'])
-                                self.players[old_pacman]['x'] = spawn_pos[0]
-                                self.players[old_pacman]['y'] = spawn_pos[1]
-                                self.players[old_pacman]['color'] = self.get_ghost_color()
+                                pacman.x, pacman.y = next(self.ghost_spawn_cycle)
+                                # Снова выбранный Пакменом остается желтым и без цвета из палитры
+                                if old_pacman != self.pacman_player_id:
+                                    pacman.color_index = self.get_ghost_color_index()
+                                    pacman.color = self.ghost_colors_available[pacman.color_index]
+
+                            # Бывший Пакмен больше не ловится остальными призраками этого цикла:
+                            # иначе роли и цвета переназначались бы повторно
+                            break
                         else:
                             # Возрождаем Пакмена в центре
-                            current_map = self.maps[self.current_map]
-                            self.players[player_id]['x'] = current_map['pacman_spawn'][0]
-                            self.players[player_id]['y'] = current_map['pacman_spawn'][1]
-                            logger.info(f"❤️ Пакмен отогрелся! Осталось жизней: {self.players[player_id]['lives']}")
+                            pacman.x, pacman.y = self.maps[self.current_map]['pacman_spawn']
+                            logger.info("❤️ Пакмен отогрелся! Осталось жизней: %s", pacman.lives)
+
+        return collided
 
     async def send_game_state(self, player_id: str):
         """Отправка состояния игры конкретному игроку"""
         if player_id not in self.players:
             return
 
-        game_state = await self.prepare_game_state(player_id)
-        try:
-            await self.players[player_id]['websocket'].send(json.dumps(game_state))
-        except:
-            pass
+        player_data = self.players[player_id]
+        payload = self.encode_shared_state(self.prepare_shared_state()) + self.personal_suffix(player_id, player_data)
+        # Если сокет занят, сообщение первым уйдет из очереди после запуска отправки
+        self.broadcast_message((player_data,), payload)
 
     async def broadcast_game_state(self):
         """Рассылка состояния игры всем игрокам"""
-        # Проверяем восстановление снежинок
-        await self.check_snowflake_respawn()
-
-        tasks = []
-        for player_id in self.players.keys():
-            game_state = await self.prepare_game_state(player_id)
-            tasks.append(
-                self.players[player_id]['websocket'].send(json.dumps(game_state))
-            )
-
-        # Игнорируем ошибки отправки
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for result in results:
-            if isinstance(result, Exception):
-                pass
-
-    async def prepare_game_state(self, player_id: str) -> Dict:
-        """Подготовка состояния игры для игрока"""
-        players_data = {}
-        for pid, pdata in self.players.items():
-            players_data[pid] = {
-                'x': pdata['x'],
-                'y': pdata['y'],
-                'role': pdata['role'],
-                'color': pdata['color'],
-                'score': pdata.get('score', 0),
-                'power_mode': pdata.get('power_mode', False),
-                'lives': pdata.get('lives', 3),
-                'name': pdata.get('name', f'Player{pid}'),
-                'voice_chat': pdata.get('voice_chat', False),
-                'muted': pdata.get('muted', False)
-            }
+        # Общая часть состояния сериализуется один раз на рассылку,
+        # для каждого игрока дописываются только его роль и id
+        player_changes = self.refresh_player_views()
+        removed_players = self.removed_players
+        self.removed_players = []
+        shared_state = self.prepare_shared_state(self.player_views)
+        previous = self.last_shared_state
+        self.last_shared_state = shared_state
+
+        # После смены карты (setup_map сбрасывает базу) клиенты с 'delta'
+        # получают полный снимок вместе со статикой
+        full_for_all = previous is None
+
+        # Полное состояние с оформлением карты и без него (для 'static_map')
+        shared_json = {}
+        delta_recipients = []
+        for player_id, player_data in self.player_entries:
+            if 'delta' in player_data.features and not player_data.needs_full_state and not full_for_all:
+                delta_recipients.append(player_data)
+                continue
+
+            with_map = 'static_map' not in player_data.features
+            if not with_map and (player_data.needs_full_state or full_for_all):
+                # Карта уходит перед полным состоянием: после 'hello', сброса очереди и смены карты
+                self.broadcast_message((player_data,), self.current_map_message)
+            if with_map not in shared_json:
+                shared_json[with_map] = self.encode_shared_state(shared_state, with_map)
+            payload = shared_json[with_map] + self.personal_suffix(player_id, player_data)
+            player_data.needs_full_state = False
+            self.broadcast_message((player_data,), payload)
+
+        if delta_recipients:
+            # Изменения одинаковы для всех: сериализуются и сжимаются один раз
+            self.broadcast_message(delta_recipients, json_dumps_bytes(
+                self.prepare_delta(previous, shared_state, player_changes, removed_players)
+            ))
+
+    async def game_loop(self):
+        """Игровой цикл: не больше одной рассылки состояния за тик"""
+        tick_interval = 1 / self.TICK_RATE
+        while True:
+            await asyncio.sleep(tick_interval)
+
+            # Ошибка одного тика не должна останавливать рассылку всем игрокам
+            try:
+                # Проверяем восстановление снежинок
+                await self.check_snowflake_respawn()
+
+                if self.state_changed:
+                    self.state_changed = False
+                    await self.broadcast_game_state()
+            except Exception:
+                logger.exception("❌ Ошибка в игровом цикле")
+
+    def refresh_player_views(self) -> Dict[str, Dict]:
+        """Обновление состояний игроков на месте; изменения с прошлой рассылки"""
+        # Для игроков - только изменившиеся поля, новые игроки целиком
+        changes = {}
+        for player_id, player_data in self.player_entries:
+            changed = player_data.refresh_view()
+            if not player_data.announced:
+                player_data.announced = True
+                changes[player_id] = player_data.view
+            elif changed:
+                changes[player_id] = changed
+        return changes
+
+    def prepare_delta(self, previous: Dict, current: Dict, player_changes: Dict,
+                      removed_players: List[str]) -> Dict:
+        """Изменения общей части состояния с прошлой рассылки"""
+        # Свою роль клиент берет из players[your_id]
+        delta = {'type': 'delta', 'players': player_changes}
+
+        if removed_players:
+            delta['removed_players'] = removed_players
+
+        # Списки снежинок и сосулек меняются редко - отправляем их только при изменении;
+        # без изменений между рассылками это один и тот же объект списка
+        for key in ('dots', 'power_pellets'):
+            if current[key] is not previous[key]:
+                delta[key] = current[key]
+
+        if current['pacman_id'] != previous['pacman_id']:
+            delta['pacman_id'] = current['pacman_id']
+
+        return delta
+
+    def encode_shared_state(self, shared_state: Dict, with_map: bool = True) -> bytes:
+        """JSON (UTF-8) общей части состояния, без закрывающей скобки
+
+        with_map=False - без стен и оформления карты, они уже отправлены сообщением 'map'
+        """
+        prefix = self.current_state_prefix if with_map else self.current_light_state_prefix
+        return prefix + b',' + json_dumps_bytes(shared_state)[1:-1]
+
+    def personal_suffix(self, player_id: str, player_data: Player) -> bytes:
+        """Окончание состояния игры для конкретного игрока"""
+        # Роль и id игрока - простые ASCII-строки, экранирование не требуется
+        return f',"your_role":"{player_data.role}","your_id":"{player_id}"}}'.encode()
+
+    def prepare_shared_state(self, players_data: Optional[Dict] = None) -> Dict:
+        """Динамическая общая для всех игроков часть состояния игры (без полей карты)"""
+        # Без готовых состояний (отправка одному игроку) собираем свежие,
+        # не трогая view - изменения в них копятся до следующей рассылки
+        if players_data is None:
+            players_data = {pid: pdata.to_state() for pid, pdata in self.players.items()}
+
+        # Списки пересобираются только после того, как снежинку съели или восстановили;
+        # готовый список не изменяется - на него может ссылаться прошлая рассылка
+        # Отбор по маске идет в C (itertools.compress), без обращений к полям объектов
+        if self.active_dots is None:
+            self.active_dots = list(itertools.compress(self.dots, self.dots_present))
+        if self.active_pellets is None:
+            self.active_pellets = list(itertools.compress(self.power_pellets, self.pellets_present))
 
         return {
-            'type': 'game_state',
             'players': players_data,
-            'dots': [dot for dot in self.dots if not dot.get('eaten', False)],
-            'power_pellets': [pellet for pellet in self.power_pellets if not pellet['eaten']],
-            'walls': self.walls,
-            'snowflakes': self.snowflakes,
-            'current_map': self.current_map,
-            'map_name': self.maps[self.current_map]['name'],
-            'map_theme': self.maps[self.current_map]['background'],
-            'your_role': self.players[player_id]['role'],
-            'your_id': player_id,
-            'pacman_id': self.pacman_player_id,
-            'season': 'winter',
-            'time_of_day': 'night'
+            'dots': self.active_dots,
+            'power_pellets': self.active_pellets,
+            'pacman_id': self.pacman_player_id
         }
 
     async def cleanup_player(self, player_id: str):
         """Очистка данных игрока при отключении"""
         if player_id in self.players:
             # Сохраняем статистику если игрок был Пакменом
-            if player_id == self.pacman_player_id and 'name' in self.players[player_id]:
-                username = self.players[player_id]['name']
-                score = self.players[player_id]['score']
-                self.db.update_player_rating(username, score, True)
-                logger.info(f"🏆 Сохранена статистика для {username}: {score} очков")
+            if player_id == self.pacman_player_id:
+                username = self.players[player_id].name
+                score = self.players[player_id].score
+                self.db_queue.put_nowait((username, score, True))
 
             # Освобождаем цвет призрака
-            if self.players[player_id]['role'] == 'ghost':
-                color = tuple(self.players[player_id]['color'])
-                if color in self.used_ghost_colors:
-                    self.used_ghost_colors.remove(color)
+            if self.players[player_id].color_index is not None:
+                self.free_color_mask |= 1 << self.players[player_id].color_index
 
             # Если отключился Пакмен, назначаем нового
             if player_id == self.pacman_player_id:
                 self.pacman_player_id = None
-                logger.info(f"⚡ Пакмен отключился! Ищем нового...")
+                logger.info("⚡ Пакмен отключился! Ищем нового...")
+
+            # Останавливаем отправку из очереди
+            if self.players[player_id].writer:
+                self.players[player_id].writer.cancel()
 
             # Удаляем игрока
-            if self.players[player_id]['websocket'] in self.connected_clients:
-                self.connected_clients.remove(self.players[player_id]['websocket'])
+            if self.players[player_id].websocket in self.connected_clients:
+                self.connected_clients.remove(self.players[player_id].websocket)
+            if self.players[player_id].announced:
+                self.removed_players.append(player_id)
+            self.player_entries.remove((player_id, self.players[player_id]))
+            del self.player_views[player_id]
             del self.players[player_id]
 
             # Перераспределяем роли
             self.assign_roles()
+            self.state_changed = True
+
+    async def db_worker(self):
+        """Запись рейтингов в базу в отдельном потоке, не задерживая игровой цикл"""
+        while True:
+            username, score, is_win = await self.db_queue.get()
+            try:
+                await asyncio.to_thread(self.db.update_player_rating, username, score, is_win)
+                logger.info("🏆 Сохранена статистика для %s: %s очков", username, score)
+            except sqlite3.Error as e:
+                logger.error("❌ Ошибка сохранения рейтинга %s: %s", username, e)
+            except Exception:
+                logger.exception("❌ Непредвиденная ошибка сохранения рейтинга %s", username)
+            finally:
+                # Кэш сбрасывается и после неудачной записи: таблица могла быть прочитана,
+                # пока запись шла (для базы в памяти - в том же соединении)
+                self.db.invalidate_leaderboard()
+                self.db_queue.task_done()
 
     async def run_server(self):
         """Запуск WebSocket сервера"""
@@ -937,24 +1555,96 @@ class WebSocketPacmanServer:
             ping_timeout=40
         )
 
-        logger.info(f"✅ Сервер запущен на ws://{self.host}:{self.port}")
+        # Рассылка состояния идет по тикам, а не на каждое входящее сообщение
+        game_loop = asyncio.create_task(self.game_loop())
+        db_worker = asyncio.create_task(self.db_worker())
+
+        logger.info("✅ Сервер запущен на ws://%s:%s", self.host, self.port)
         logger.info("⏹️  Для остановки нажмите Ctrl+C")
 
-        await asyncio.Future()
+        try:
+            await asyncio.Future()
+        finally:
+            # Закрываем соединения и ждем их обработчики: cleanup_player
+            # ставит в очередь результат текущего Пакмена
+            server.close()
+            await server.wait_closed()
+            game_loop.cancel()
+            # Дописываем рейтинги, которые еще в очереди, и только потом останавливаем запись
+            await self.db_queue.join()
+            db_worker.cancel()
+
+
+def run_async(coro):
+    """Запуск корутины в цикле событий uvloop, если он установлен"""
+    if uvloop is None:
+        asyncio.run(coro)
+    elif hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(coro)
+    else:
+        uvloop.install()
+        asyncio.run(coro)
+
+
+def run_worker(host: str, port: int, log_level: str = 'INFO'):
+    """Запуск одного процесса сервера"""
+    # На WARNING игровые события не форматируются и не пишутся совсем
+    logger.setLevel(log_level)
+    server = WebSocketPacmanServer(host, port)
+
+    try:
+        run_async(server.run_server())
+    except KeyboardInterrupt:
+        print("\n🛑 Сервер остановлен")
+    except Exception as e:
+        print(f"❌ Критическая ошибка сервера: {e}")
+
+
+def non_negative_int(value: str) -> int:
+    """Целое не меньше нуля для аргументов командной строки"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'ожидается число >= 0, получено {value}')
+    return number
 
 
 def main():
     """Основная функция"""
+    parser = argparse.ArgumentParser(description='Winter Pacman MultiPlayer Server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5556)
+    parser.add_argument('--workers', type=non_negative_int, default=1,
+                        help='число процессов (0 - по числу ядер); каждый ведет свое лобби '
+                             'на своем порту: --port, --port + 1, ..., --port + workers - 1')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='уровень журнала; WARNING отключает сообщения о каждом игровом событии')
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
     print("🎮 Запуск Winter Pacman MultiPlayer Server...")
 
-    server = WebSocketPacmanServer()
+    if workers == 1:
+        run_worker(args.host, args.port, args.log_level)
+        return
+
+    # Каждое лобби - отдельный процесс на своем порту: игроки одной игры
+    # подключаются к одному порту, рейтинги общие через SQLite в режиме WAL
+    ports = [args.port + i for i in range(workers)]
+    print(f"🏠 Лобби на портах: {', '.join(map(str, ports))}")
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(args.host, port, args.log_level))
+        for port in ports
+    ]
+    for process in processes:
+        process.start()
 
     try:
-        asyncio.run(server.run_server())
+        for process in processes:
+            process.join()
     except KeyboardInterrupt:
-        print("\n🛑 Сервер остановлен")
-    except Exception as e:
-        print(f"❌ Критическая ошибка сервера: {e}")
+        for process in processes:
+            process.join()
 
 
 if __name__ == "__main__":